@@ -1,8 +1,28 @@
-from sqlalchemy import Column, Integer, String, Date, Time, JSON
+import logging
+from functools import cached_property
+from pathlib import Path
+import numpy as np
+import orjson
+from sqlalchemy import (
+    Column, Integer, String, Date, Time, JSON, ForeignKey, UniqueConstraint,
+    create_engine, delete, event, func, inspect, select
+)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Telegram rejects inline buttons whose callback data exceeds 64 bytes
+CALLBACK_DATA_LIMIT = 64
+
+# Columns identifying one shift, so a re-uploaded shift replaces the old row
+SCHEDULE_KEY = ['driver_id', 'date', 'umlauf']
+
+# Thread-local sessions shared by the whole bot; bound by init_db
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+
 class Driver(Base):
     __tablename__ = 'drivers'
     id = Column(Integer, primary_key=True)
@@ -11,17 +31,81 @@ class Driver(Base):
 
 class Schedule(Base):
     __tablename__ = 'schedules'
+    # One row per driver, day and Umlauf; also serves (driver_id, date) lookups
+    __table_args__ = (UniqueConstraint(*SCHEDULE_KEY, name='uq_schedule_driver_date_umlauf'),)
     id = Column(Integer, primary_key=True)
-    driver_id = Column(Integer)
+    driver_id = Column(Integer, ForeignKey('drivers.id'))
     date = Column(Date)
     umlauf = Column(String)
     start_time = Column(Time)
     end_time = Column(Time)
     routes = Column(JSON)
+    driver = relationship('Driver')
 
 class BusRoute(Base):
     __tablename__ = 'bus_routes'
-    id = Column(Integer, primary_key=True)
-    route_number = Column(String)
+    route_number = Column(String, primary_key=True)
     name = Column(String)
     stations = Column(JSON)
+
+    @cached_property
+    def station_index(self):
+        """Map casefolded, whitespace-normalised station names to their position on the route"""
+        return {" ".join(station['name'].split()).casefold(): i for i, station in enumerate(self.stations)}
+
+    @cached_property
+    def coords_rad(self):
+        """Station coordinates as one (N, 2) array of radians, for vectorised distances"""
+        return np.radians(np.array([station['coords'] for station in self.stations], dtype=np.float64))
+
+
+def _add_schedule_key(engine):
+    """Add the unique shift key to a schedules table created before it existed"""
+    # create_all never alters existing tables, but the schedule upsert needs this key
+    inspector = inspect(engine)
+    if any(c['column_names'] == SCHEDULE_KEY for c in inspector.get_unique_constraints('schedules')):
+        return
+    if any(i['unique'] and i['column_names'] == SCHEDULE_KEY for i in inspector.get_indexes('schedules')):
+        return
+    with engine.begin() as conn:
+        # Keep the newest row of each shift so the index can be built
+        newest = select(func.max(Schedule.id)).group_by(Schedule.driver_id, Schedule.date, Schedule.umlauf)
+        conn.execute(delete(Schedule).where(Schedule.id.not_in(newest)))
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX uq_schedule_driver_date_umlauf ON schedules (driver_id, date, umlauf)"
+        )
+
+def init_db(database_url: str):
+    """Create a pooled engine for database_url, create missing tables and bind Session"""
+    if database_url.startswith('sqlite'):
+        engine = create_engine(database_url, connect_args={"check_same_thread": False})
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA cache_size=-64000")
+            cursor.close()
+    else:
+        engine = create_engine(database_url, pool_pre_ping=True, pool_size=10, max_overflow=20)
+
+    Base.metadata.create_all(engine)
+    _add_schedule_key(engine)
+    Session.configure(bind=engine)
+    return engine
+
+def load_bus_routes(path):
+    """Upsert bus routes from a JSON file of {route_number: {name, stations}}"""
+    routes = orjson.loads(Path(path).read_bytes())
+    session = Session()
+    try:
+        for route_number, route in routes.items():
+            # Longest callback data the bot builds for a route is "n<route>:<leg>"
+            if len(f"n{route_number}:{len(route['stations'])}".encode()) > CALLBACK_DATA_LIMIT:
+                logger.warning(f"Skipping route {route_number}: number too long for button callback data")
+                continue
+            session.merge(BusRoute(route_number=route_number, name=route['name'], stations=route['stations']))
+        session.commit()
+    finally:
+        Session.remove()
@@ -1,28 +1,43 @@
 import os
 import io
+import csv
+import asyncio
 import logging
 import re
-from datetime import datetime
+import threading
+from functools import lru_cache
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, time
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from PIL import Image
-import pytesseract
+
+# Tesseract's OpenMP threading scales poorly; parallelise across pages instead.
+# Must be set before tesseract is loaded.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+from tesserocr import OEM, PSM, PyTessBaseAPI
 import cv2
 import numpy as np
-from pdf2image import convert_from_bytes
+import fitz
 from dotenv import load_dotenv
-from telegram import Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions
 from telegram.ext import (
-    Updater,
+    AIORateLimiter,
+    Application,
     CommandHandler,
     MessageHandler,
-    Filters,
-    CallbackContext,
+    filters,
+    ContextTypes,
     CallbackQueryHandler
 )
 
 # Database imports
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database import Base, Driver, Schedule, BusRoute
+from sqlalchemy import and_, delete, insert, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import init_db, load_bus_routes, Session, Driver, Schedule, BusRoute, CALLBACK_DATA_LIMIT, SCHEDULE_KEY
 
 # Load environment variables
 load_dotenv()
@@ -36,108 +51,434 @@ logger = logging.getLogger(__name__)
 
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///schedules.db")
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+# Created by main()
+engine = None
+# Dialects whose insert supports ON CONFLICT upserts
+_UPSERT_INSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+# Route data is maintained in a JSON file, so it can change without a redeploy
+BUS_ROUTES_FILE = os.getenv("BUS_ROUTES_FILE", "data/bus_routes.json")
 
 # OCR Configuration
-pytesseract.pytesseract.tesseract_cmd = '/usr/bin/tesseract'
 TESSDATA_PREFIX = os.getenv("TESSDATA_PREFIX", "/usr/share/tesseract-ocr/4.00/tessdata")
+PDF_DPI = 150
+MAX_OCR_SIDE = 1600
+# Schedules only contain German text, so one language model is enough
+OCR_LANG = 'deu'
+# Everything the schedule patterns below can match
+OCR_CHAR_WHITELIST = '0123456789:-, DateUmlaufTimeRoutes'
+
+# OCR runs in worker processes so it never blocks the event loop. Each worker
+# holds one in-process tesseract instance, so the language models are loaded
+# once per worker instead of on every page.
+_TESS_API = None
+
+def _init_ocr_worker():
+    """Give each OCR worker process its own tesseract instance"""
+    global _TESS_API
+    # Schedules are one uniform text block, so skip full page layout analysis
+    _TESS_API = PyTessBaseAPI(
+        path=TESSDATA_PREFIX, lang=OCR_LANG, psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY
+    )
+    _TESS_API.SetVariable('preserve_interword_spaces', '1')
+    _TESS_API.SetVariable('tessedit_char_whitelist', OCR_CHAR_WHITELIST)
+
+def _new_ocr_pool():
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_ocr_worker)
+
+# Started by main()
+_OCR_POOL = None
+MAX_PAGES_IN_FLIGHT = 2 * (os.cpu_count() or 1)
+
+# OCR text by Telegram file_unique_id, so identical uploads are OCRed once
+_OCR_TEXT_CACHE = TTLCache(maxsize=256, ttl=86400)
+
+# Schedule parsing patterns - customize based on your schedule format
+_DATE_RE = re.compile(r'Date:\s*(\d{4}-\d{2}-\d{2})')
+_SHIFT_RE = re.compile(r'Umlauf:\s*(\w+)\s*Time:\s*(\d{2}:\d{2})-(\d{2}:\d{2})\s*Routes:\s*([\d,]+)')
 
 # --------------------------
 # Database Helper Functions
 # --------------------------
 
+async def run_db(func, *args):
+    """Run a blocking database helper in a worker thread"""
+    def call():
+        try:
+            return func(*args)
+        finally:
+            Session.remove()
+    return await asyncio.to_thread(call)
+
 def get_driver(telegram_id: int):
     """Retrieve driver from database"""
-    with Session() as session:
-        return session.query(Driver).filter_by(telegram_id=telegram_id).first()
+    return Session.query(Driver).filter_by(telegram_id=telegram_id).first()
 
-def get_schedule(driver_id: int, date: datetime):
-    """Get schedule for a specific date"""
-    with Session() as session:
-        return session.query(Schedule).filter(
-            Schedule.driver_id == driver_id,
-            Schedule.date == date.date()
-        ).all()
+def add_driver(name: str, telegram_id: int):
+    """Register a new driver"""
+    Session.add(Driver(name=name, telegram_id=telegram_id))
+    Session.commit()
+
+# Schedules are read far more often than uploaded; store_schedules evicts
+# the cached days it changes.
+_SCHEDULE_CACHE = TTLCache(maxsize=1024, ttl=300)
+_SCHEDULE_CACHE_LOCK = threading.Lock()
 
+@cached(_SCHEDULE_CACHE, lock=_SCHEDULE_CACHE_LOCK)
+def get_schedule(driver_id: int, day: date):
+    """Get schedule for a specific date"""
+    return Session.query(Schedule).filter(
+        Schedule.driver_id == driver_id,
+        Schedule.date == day
+    ).all()
+
+def store_schedules(rows):
+    """Store parsed shifts, replacing re-uploaded ones, and evict their cached days"""
+    # A single statement may not touch the same row twice; the last shift wins
+    rows = list({tuple(row[column] for column in SCHEDULE_KEY): row for row in rows}.values())
+    if rows:
+        if engine.dialect.name not in _UPSERT_INSERTS:
+            # No ON CONFLICT on this dialect, so drop the re-uploaded shifts first
+            Session.execute(delete(Schedule).where(or_(*(
+                and_(*(getattr(Schedule, column) == row[column] for column in SCHEDULE_KEY))
+                for row in rows
+            ))))
+        Session.execute(_schedule_upsert(), rows)
+    Session.commit()
+    with _SCHEDULE_CACHE_LOCK:
+        for row in rows:
+            _SCHEDULE_CACHE.pop(hashkey(row['driver_id'], row['date']), None)
+
+# Route data is nearly static, so lookups are cached. Cached objects are
+# expunged from the session, which keeps them usable after Session.remove().
+_ROUTE_CACHE = TTLCache(maxsize=256, ttl=300)
+_ROUTE_CACHE_LOCK = threading.Lock()
+
+@cached(_ROUTE_CACHE, lock=_ROUTE_CACHE_LOCK)
 def get_bus_route(route_number: str):
     """Get bus route details"""
-    with Session() as session:
-        return session.query(BusRoute).filter_by(route_number=route_number).first()
+    route = Session.get(BusRoute, route_number)
+    if route:
+        Session.expunge(route)
+    return route
+
+def is_bus_route_cached(route_number: str) -> bool:
+    """Check whether get_bus_route can answer without a query"""
+    with _ROUTE_CACHE_LOCK:
+        return hashkey(route_number) in _ROUTE_CACHE
+
+def prefetch_bus_routes(route_numbers):
+    """Load uncached routes in one query so get_bus_route hits the cache"""
+    with _ROUTE_CACHE_LOCK:
+        missing = [number for number in route_numbers if hashkey(number) not in _ROUTE_CACHE]
+    if not missing:
+        return
+    routes = Session.query(BusRoute).filter(BusRoute.route_number.in_(missing)).all()
+    for route in routes:
+        Session.expunge(route)
+    with _ROUTE_CACHE_LOCK:
+        for route in routes:
+            _ROUTE_CACHE[hashkey(route.route_number)] = route
 
+@cached(TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
 def get_all_routes():
     """Get all bus routes"""
-    with Session() as session:
-        return session.query(BusRoute).all()
+    routes = Session.query(BusRoute).all()
+    for route in routes:
+        Session.expunge(route)
+    return routes
 
 # --------------------------
 # Image Processing Functions
 # --------------------------
 
 def process_image(image):
-    """Process image for OCR using OpenCV"""
-    # Convert to OpenCV format
-    img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    """Process image (PIL or OpenCV BGR array) for OCR using OpenCV"""
+    # Convert straight to grayscale
+    if isinstance(image, Image.Image):
+        gray = np.asarray(image.convert('L'))
+    else:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
-    # Preprocessing
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # Preprocessing - recognition cost grows with pixel count, so cap the size
+    # UMat lets OpenCV run these on OpenCL if present, CPU otherwise
+    long_side = max(gray.shape)
+    gray = cv2.UMat(gray)
+    if long_side > MAX_OCR_SIDE:
+        scale = MAX_OCR_SIDE / long_side
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Adaptive thresholding copes with uneven lighting on scans better than Otsu
+    thresh = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10
+    ).get()
     
     # OCR processing
-    return pytesseract.image_to_string(
-        thresh,
-        lang='deu+eng',
-        config=f'--tessdata-dir "{TESSDATA_PREFIX}"'
+    _TESS_API.SetImage(Image.fromarray(thresh))
+    return _TESS_API.GetUTF8Text()
+
+async def run_ocr(image) -> str:
+    """OCR an image in the worker pool, replacing the pool if a worker died"""
+    global _OCR_POOL
+    pool = _OCR_POOL
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, process_image, image)
+    except BrokenProcessPool:
+        # One dead worker (e.g. OOM-killed) breaks the pool for every later job;
+        # concurrent pages share the same broken pool, so only the first replaces it
+        if _OCR_POOL is pool:
+            logger.warning("OCR worker died, restarting the OCR pool")
+            _OCR_POOL = _new_ocr_pool()
+            pool.shutdown(wait=False)
+        raise
+
+def iter_pdf_pages(data):
+    """Rasterise PDF pages in-process to grayscale PIL images, one at a time"""
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=PDF_DPI, colorspace=fitz.csGRAY)
+            yield Image.frombytes('L', (pix.width, pix.height), pix.samples)
+
+async def ocr_pdf(data) -> str:
+    """OCR a PDF, rendering the next page while earlier pages are recognised"""
+    pages = iter_pdf_pages(data)
+    # Bounds how many rendered pages wait for OCR at once
+    slots = asyncio.Semaphore(MAX_PAGES_IN_FLIGHT)
+
+    async def ocr_page(image):
+        try:
+            return await run_ocr(image)
+        finally:
+            slots.release()
+
+    tasks = []
+    while True:
+        await slots.acquire()
+        image = await asyncio.to_thread(next, pages, None)
+        if image is None:
+            slots.release()
+            break
+        tasks.append(asyncio.create_task(ocr_page(image)))
+    return "\n".join(await asyncio.gather(*tasks))
+
+async def download_document(document, bot) -> io.BytesIO:
+    """Download an uploaded document into memory"""
+    # Download into one buffer that the PDF, image and CSV readers consume directly
+    file = await bot.get_file(document.file_id)
+    buf = io.BytesIO()
+    await file.download_to_memory(out=buf)
+    buf.seek(0)
+    return buf
+
+async def ocr_document(document, bot) -> str:
+    """Download an uploaded image or PDF and return its OCR text"""
+    buf = await download_document(document, bot)
+
+    # Process PDF files
+    if document.mime_type == 'application/pdf':
+        # PyMuPDF before 1.28.2 rejects memoryview streams, so pass the buffer itself
+        return await ocr_pdf(buf)
+    # Process image files
+    image = Image.open(buf)
+    return await run_ocr(image)
+
+def _parse_time(value: str) -> time:
+    """Parse HH:MM without going through strptime"""
+    hh, mm = value.split(':')
+    return time(int(hh), int(mm))
+
+def _parse_routes(value: str) -> list:
+    """Split a comma-separated route list, skipping blanks and unusable numbers"""
+    routes = []
+    for route in value.split(','):
+        route = route.strip()
+        if not route:
+            continue
+        # Every route becomes an "r<route>" details button in /schedule
+        if len(f"r{route}".encode()) > CALLBACK_DATA_LIMIT:
+            logger.warning(f"Skipping route {route}: number too long for button callback data")
+            continue
+        routes.append(route)
+    return routes
+
+def _schedule_upsert():
+    """Bulk insert statement for schedules that replaces re-uploaded shifts"""
+    dialect_insert = _UPSERT_INSERTS.get(engine.dialect.name)
+    if dialect_insert is None:
+        # store_schedules deletes the shifts being replaced before this insert
+        return insert(Schedule)
+    stmt = dialect_insert(Schedule)
+    return stmt.on_conflict_do_update(
+        index_elements=SCHEDULE_KEY,
+        set_={column: stmt.excluded[column] for column in ('start_time', 'end_time', 'routes')}
     )
 
 def parse_schedule_text(text: str, driver_id: int):
     """Parse OCR text into schedule data"""
     try:
-        with Session() as session:
-            # Example parsing pattern - customize based on your schedule format
-            date_pattern = re.compile(r'Date:\s*(\d{4}-\d{2}-\d{2})')
-            shift_pattern = re.compile(r'Umlauf:\s*(\w+)\s*Time:\s*(\d{2}:\d{2})-(\d{2}:\d{2})\s*Routes:\s*([\d,]+)')
-
-            current_date = None
-            for line in text.split('\n'):
-                date_match = date_pattern.search(line)
-                if date_match:
-                    current_date = datetime.strptime(date_match.group(1), '%Y-%m-%d')
-                    continue
-                
-                if current_date:
-                    shift_match = shift_pattern.search(line)
-                    if shift_match:
-                        schedule = Schedule(
-                            driver_id=driver_id,
-                            date=current_date,
-                            umlauf=shift_match.group(1),
-                            start_time=datetime.strptime(shift_match.group(2), '%H:%M').time(),
-                            end_time=datetime.strptime(shift_match.group(3), '%H:%M').time(),
-                            routes=shift_match.group(4).split(',')
-                        )
-                        session.add(schedule)
-            
-            session.commit()
+        date_matches = list(_DATE_RE.finditer(text))
+        date_offsets = [match.start() for match in date_matches]
+        dates = [date.fromisoformat(match.group(1)) for match in date_matches]
+
+        rows = []
+        for shift_match in _SHIFT_RE.finditer(text):
+            # A shift belongs to the last date header before it
+            i = bisect_left(date_offsets, shift_match.start())
+            if i:
+                rows.append({
+                    'driver_id': driver_id,
+                    'date': dates[i - 1],
+                    'umlauf': shift_match.group(1),
+                    'start_time': _parse_time(shift_match.group(2)),
+                    'end_time': _parse_time(shift_match.group(3)),
+                    'routes': _parse_routes(shift_match.group(4))
+                })
+        
+        # Insert all shifts in one executemany instead of one INSERT per row
+        store_schedules(rows)
         return True
     except Exception as e:
+        Session.rollback()
         logger.error(f"Error parsing schedule: {str(e)}")
         return False
 
+def is_csv_document(document) -> bool:
+    """Whether an upload is a CSV schedule rather than an image or PDF"""
+    return (
+        document.mime_type in ('text/csv', 'text/comma-separated-values')
+        or (document.file_name or '').lower().endswith('.csv')
+    )
+
+def parse_schedule_csv(data, driver_id: int):
+    """Import a CSV schedule with columns date,umlauf,start_time,end_time,routes"""
+    try:
+        # csv parses the in-memory upload directly, no temporary file
+        reader = csv.reader(io.TextIOWrapper(data, encoding='utf-8-sig', newline=''))
+        columns = {name.strip(): i for i, name in enumerate(next(reader))}
+        date_col, umlauf_col, start_col, end_col, routes_col = (
+            columns[name] for name in ('date', 'umlauf', 'start_time', 'end_time', 'routes')
+        )
+
+        rows = [
+            {
+                'driver_id': driver_id,
+                'date': date.fromisoformat(row[date_col]),
+                'umlauf': row[umlauf_col],
+                'start_time': _parse_time(row[start_col]),
+                'end_time': _parse_time(row[end_col]),
+                'routes': _parse_routes(row[routes_col])
+            }
+            for row in reader if row
+        ]
+
+        store_schedules(rows)
+        return True
+    except Exception as e:
+        Session.rollback()
+        logger.error(f"Error parsing schedule CSV: {str(e)}")
+        return False
+
+# --------------------------
+# Navigation Helpers
+# --------------------------
+
+EARTH_RADIUS_M = 6_371_000
+
+def haversine_vector(lat1, lon1, lats, lons):
+    """Great-circle distances in metres from one point to many, all in radians"""
+    dphi = lats - lat1
+    dlmbd = lons - lon1
+    a = np.sin(dphi / 2) ** 2 + np.cos(lat1) * np.cos(lats) * np.sin(dlmbd / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def nearest_station(routes, lat: float, lon: float):
+    """Find the (route, station, distance in metres) closest to a position"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    best = None
+    for route in routes:
+        if not route.stations:
+            continue
+        distances = haversine_vector(lat, lon, route.coords_rad[:, 0], route.coords_rad[:, 1])
+        i = int(np.argmin(distances))
+        if best is None or distances[i] < best[2]:
+            best = (route, route.stations[i], float(distances[i]))
+    return best
+
+@lru_cache(maxsize=1024)
+def get_directions(from_station: str, to_station: str) -> str:
+    """Driving directions between two stations, memoised per station pair"""
+    # Replace with a navigation API (e.g. OSRM) for real turn-by-turn directions
+    return f"Fahre von {from_station} nach {to_station}. Folge der Hauptstraße."
+
+# Station coordinates are static, so each route's leg links are formatted once
+
+@cached(TTLCache(maxsize=256, ttl=300), key=lambda route: hashkey(route.route_number))
+def route_leg_links(route) -> dict:
+    """Google Maps directions links between adjacent stations, keyed by (from, to) index"""
+    points = [f"{s['coords'][0]},{s['coords'][1]}" for s in route.stations]
+    links = {}
+    for i, (a, b) in enumerate(zip(points, points[1:])):
+        links[i, i + 1] = f"https://www.google.com/maps/dir/{a}/{b}"
+        links[i + 1, i] = f"https://www.google.com/maps/dir/{b}/{a}"
+    return links
+
+@cached(TTLCache(maxsize=256, ttl=300), key=lambda route: hashkey(route.route_number))
+def route_leg_texts(route) -> tuple:
+    """Navigation text per leg, as (forward, reverse) lists indexed by the lower station"""
+    links = route_leg_links(route)
+
+    def leg_text(i, j):
+        a, b = route.stations[i]['name'], route.stations[j]['name']
+        return f"Von {a} nach {b}\n   {get_directions(a, b)}\n   Karte: {links[i, j]}"
+
+    legs = range(len(route.stations) - 1)
+    return [leg_text(i, i + 1) for i in legs], [leg_text(i + 1, i) for i in legs]
+
+# --------------------------
+# Keyboard Helpers
+# --------------------------
+
+# Route keyboards only change with the route data, so they are built once and
+# reused until the cached routes themselves expire.
+
+@cached(TTLCache(maxsize=1, ttl=60), key=lambda routes: hashkey(*(r.route_number for r in routes)))
+def routes_list_markup(routes) -> InlineKeyboardMarkup:
+    """One details button per route"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Linie {route.route_number}", callback_data=f"r{route.route_number}")]
+        for route in routes
+    ])
+
+def schedule_routes_markup(route_numbers) -> InlineKeyboardMarkup:
+    """One details button per route of a schedule"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Linie {route} Details", callback_data=f"r{route}")]
+        for route in route_numbers
+    ])
+
+@cached(TTLCache(maxsize=256, ttl=300), key=lambda route: hashkey(route.route_number))
+def route_navigation_markup(route) -> InlineKeyboardMarkup:
+    """Navigation buttons between adjacent stations of a route"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            f"{a['name']} → {b['name']}",
+            callback_data=f"n{route.route_number}:{i}"
+        )]
+        for i, (a, b) in enumerate(zip(route.stations, route.stations[1:]))
+    ])
+
 # --------------------------
 # Telegram Command Handlers
 # --------------------------
 
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send welcome message"""
     user = update.effective_user
-    update.message.reply_text(
+    await update.message.reply_text(
         f'Hallo {user.first_name}! Ich bin dein Bus-Navigations-Bot für Heidelberg.\n'
         'Verwende /register um dich zu registrieren oder /help für Hilfe.'
     )
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show help message"""
     commands = """
 Verfügbare Befehle:
@@ -149,168 +490,245 @@ Verfügbare Befehle:
 /routes - Alle Buslinien anzeigen
 /route [NUMMER] - Details einer Buslinie
 /navigate [LINIE] [VON] [NACH] - Navigationsanweisungen
-/upload - Arbeitsplan hochladen (Bild/PDF)
+    (Haltestellen mit Leerzeichen einfach ausschreiben, z.B. /navigate 31 Hauptbahnhof Alte Brücke)
+/upload - Arbeitsplan hochladen (Bild/PDF/CSV)
+Standort senden - Nächste Haltestelle finden
 """
-    update.message.reply_text(commands)
+    await update.message.reply_text(commands)
 
-def register_command(update: Update, context: CallbackContext) -> None:
+async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Register new driver"""
     try:
-        with Session() as session:
-            driver = Driver(
-                name=update.effective_user.full_name,
-                telegram_id=update.effective_user.id
-            )
-            session.add(driver)
-            session.commit()
-        update.message.reply_text("Registrierung erfolgreich! 🎉")
+        await run_db(add_driver, update.effective_user.full_name, update.effective_user.id)
+        await update.message.reply_text("Registrierung erfolgreich! 🎉")
     except Exception as e:
-        update.message.reply_text("Registrierung fehlgeschlagen. Bitte Administrator kontaktieren.")
+        await update.message.reply_text("Registrierung fehlgeschlagen. Bitte Administrator kontaktieren.")
 
-def schedule_command(update: Update, context: CallbackContext) -> None:
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show work schedule"""
-    driver = get_driver(update.effective_user.id)
+    driver = await run_db(get_driver, update.effective_user.id)
     if not driver:
-        update.message.reply_text("Bitte zuerst mit /register registrieren.")
+        await update.message.reply_text("Bitte zuerst mit /register registrieren.")
         return
 
     # Get date from arguments or use today
     try:
-        date_str = context.args[0] if context.args else datetime.now().strftime('%Y-%m-%d')
-        target_date = datetime.strptime(date_str, '%Y-%m-%d')
+        target_date = date.fromisoformat(context.args[0]) if context.args else date.today()
     except ValueError:
-        update.message.reply_text("Ungültiges Datumsformat. Verwende YYYY-MM-DD.")
+        await update.message.reply_text("Ungültiges Datumsformat. Verwende YYYY-MM-DD.")
         return
+    date_str = target_date.isoformat()
 
-    schedules = get_schedule(driver.id, target_date)
+    schedules = await run_db(get_schedule, driver.id, target_date)
     if not schedules:
-        update.message.reply_text(f"Kein Arbeitsplan für {date_str} gefunden.")
+        await update.message.reply_text(f"Kein Arbeitsplan für {date_str} gefunden.")
         return
 
-    response = f"Arbeitsplan für {date_str}:\n\n"
-    keyboard = []
+    # Each route gets one button, even if it appears in several shifts
+    route_numbers = list(dict.fromkeys(route for schedule in schedules for route in schedule.routes))
+
+    # Warm the route cache so the detail buttons don't query one by one
+    await run_db(prefetch_bus_routes, route_numbers)
+
+    parts = [f"Arbeitsplan für {date_str}:", ""]
     for schedule in schedules:
-        response += f"Umlauf: {schedule.umlauf}\n"
-        response += f"Zeit: {schedule.start_time} - {schedule.end_time}\n"
-        response += f"Linien: {', '.join(schedule.routes)}\n\n"
-        
-        # Add buttons for each route
-        for route in schedule.routes:
-            keyboard.append([InlineKeyboardButton(
-                f"Linie {route} Details",
-                callback_data=f"route_{route}"
-            )])
-
-    update.message.reply_text(
-        response,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        parts.append(f"Umlauf: {schedule.umlauf}")
+        parts.append(f"Zeit: {schedule.start_time} - {schedule.end_time}")
+        parts.append(f"Linien: {', '.join(schedule.routes)}")
+        parts.append("")
+
+    await update.message.reply_text(
+        "\n".join(parts),
+        reply_markup=schedule_routes_markup(route_numbers)
     )
 
-def routes_command(update: Update, context: CallbackContext) -> None:
+async def routes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all bus routes"""
-    routes = get_all_routes()
+    routes = await run_db(get_all_routes)
     if not routes:
-        update.message.reply_text("Keine Buslinien gefunden.")
+        await update.message.reply_text("Keine Buslinien gefunden.")
         return
 
-    keyboard = []
-    response = "Verfügbare Buslinien:\n\n"
-    for route in routes:
-        response += f"Linie {route.route_number}: {route.name}\n"
-        keyboard.append([InlineKeyboardButton(
-            f"Linie {route.route_number}",
-            callback_data=f"route_{route.route_number}"
-        )])
+    parts = ["Verfügbare Buslinien:", ""]
+    parts.extend(f"Linie {route.route_number}: {route.name}" for route in routes)
 
-    update.message.reply_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("\n".join(parts), reply_markup=routes_list_markup(routes))
 
-def route_command(update: Update, context: CallbackContext) -> None:
+async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show route details"""
     if not context.args:
-        update.message.reply_text("Bitte Liniennummer angeben. Beispiel: /route 31")
+        await update.message.reply_text("Bitte Liniennummer angeben. Beispiel: /route 31")
         return
 
-    route = get_bus_route(context.args[0])
+    route = await run_db(get_bus_route, context.args[0])
     if not route:
-        update.message.reply_text("Buslinie nicht gefunden.")
+        await update.message.reply_text("Buslinie nicht gefunden.")
         return
 
-    response = f"Linie {route.route_number}: {route.name}\n\nStationen:\n"
-    for i, station in enumerate(route.stations):
-        response += f"{i+1}. {station['name']}\n"
-
-    # Navigation buttons
-    keyboard = []
-    for i in range(len(route.stations)-1):
-        keyboard.append([InlineKeyboardButton(
-            f"{route.stations[i]['name']} → {route.stations[i+1]['name']}",
-            callback_data=f"nav_{route.route_number}_{i}_{i+1}"
-        )])
-
-    update.message.reply_text(
-        response,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    parts = [f"Linie {route.route_number}: {route.name}", "", "Stationen:"]
+    parts.extend(f"{i+1}. {s['name']}" for i, s in enumerate(route.stations))
+
+    await update.message.reply_text(
+        "\n".join(parts),
+        reply_markup=route_navigation_markup(route)
     )
 
-def handle_document(update: Update, context: CallbackContext) -> None:
+async def navigate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show navigation between two stations of a route"""
+    if len(context.args) < 3:
+        await update.message.reply_text(
+            "Bitte Linie, Start und Ziel angeben. Beispiel: /navigate 31 Hauptbahnhof Bismarckplatz"
+        )
+        return
+
+    route_number, *words = context.args
+    route = await run_db(get_bus_route, route_number)
+    if not route:
+        await update.message.reply_text("Buslinie nicht gefunden.")
+        return
+
+    # Station names may contain spaces, so try each split of the words into start and destination
+    for split in range(1, len(words)):
+        from_idx = route.station_index.get(" ".join(words[:split]).casefold(), -1)
+        to_idx = route.station_index.get(" ".join(words[split:]).casefold(), -1)
+        if from_idx >= 0 and to_idx >= 0:
+            break
+    else:
+        await update.message.reply_text("Station nicht gefunden.")
+        return
+    if from_idx == to_idx:
+        await update.message.reply_text("Start und Ziel sind identisch.")
+        return
+
+    # Works in both directions along the route
+    forward, reverse = route_leg_texts(route)
+    if to_idx > from_idx:
+        legs = forward[from_idx:to_idx]
+    else:
+        legs = reverse[to_idx:from_idx][::-1]
+
+    parts = [
+        f"Navigation Linie {route.route_number} von {route.stations[from_idx]['name']} "
+        f"nach {route.stations[to_idx]['name']}:",
+        ""
+    ]
+    parts.extend(f"{n}. {leg}" for n, leg in enumerate(legs, 1))
+
+    # Map links would otherwise each trigger a preview fetch before delivery
+    await update.message.reply_text("\n".join(parts), link_preview_options=LinkPreviewOptions(is_disabled=True))
+
+async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the station closest to a shared location"""
+    routes = await run_db(get_all_routes)
+    location = update.message.location
+    nearest = nearest_station(routes, location.latitude, location.longitude)
+    if not nearest:
+        await update.message.reply_text("Keine Buslinien gefunden.")
+        return
+
+    route, station, distance = nearest
+    await update.message.reply_text(
+        f"Nächste Haltestelle: {station['name']} (Linie {route.route_number}), {distance:.0f} m"
+    )
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process uploaded schedule documents"""
-    driver = get_driver(update.effective_user.id)
+    driver = await run_db(get_driver, update.effective_user.id)
     if not driver:
-        update.message.reply_text("Bitte zuerst mit /register registrieren.")
+        await update.message.reply_text("Bitte zuerst mit /register registrieren.")
         return
 
-    file = context.bot.get_file(update.message.document.file_id)
-    file_bytes = file.download_as_bytearray()
+    document = update.message.document
 
     try:
-        # Process PDF files
-        if update.message.document.mime_type == 'application/pdf':
-            images = convert_from_bytes(bytes(file_bytes))
-            text = "\n".join([process_image(img) for img in images])
-        else:  # Process image files
-            image = Image.open(io.BytesIO(file_bytes))
-            text = process_image(image)
-
-        if parse_schedule_text(text, driver.id):
-            update.message.reply_text("Arbeitsplan erfolgreich aktualisiert! ✅")
+        if is_csv_document(document):
+            buf = await download_document(document, context.bot)
+            success = await run_db(parse_schedule_csv, buf, driver.id)
+        else:
+            # Re-uploads of the same file skip the download and OCR entirely
+            text = _OCR_TEXT_CACHE.get(document.file_unique_id)
+            if text is None:
+                text = await ocr_document(document, context.bot)
+                _OCR_TEXT_CACHE[document.file_unique_id] = text
+            success = await run_db(parse_schedule_text, text, driver.id)
+
+        if success:
+            await update.message.reply_text("Arbeitsplan erfolgreich aktualisiert! ✅")
         else:
-            update.message.reply_text("Fehler beim Verarbeiten des Zeitplans. ❌")
+            await update.message.reply_text("Fehler beim Verarbeiten des Zeitplans. ❌")
 
     except Exception as e:
         logger.error(f"Document processing error: {str(e)}")
-        update.message.reply_text("Fehler beim Verarbeiten der Datei. Bitte Format überprüfen.")
+        await update.message.reply_text("Fehler beim Verarbeiten der Datei. Bitte Format überprüfen.")
 
 # --------------------------
 # Callback Handlers
 # --------------------------
 
-def button_callback(update: Update, context: CallbackContext) -> None:
+async def fetch_route_for_query(query, route_number: str):
+    """Fetch a route for a button press, showing a placeholder on cache misses"""
+    if not is_bus_route_cached(route_number):
+        await query.edit_message_text("Lade…")
+    return await run_db(get_bus_route, route_number)
+
+async def handle_route_button(query, route_number: str) -> None:
+    """Show the stations of a route"""
+    route = await fetch_route_for_query(query, route_number)
+    if route:
+        parts = [f"Linie {route.route_number}: {route.name}", "Stationen:"]
+        parts.extend(f"{i+1}. {s['name']}" for i, s in enumerate(route.stations))
+        await query.edit_message_text("\n".join(parts))
+    else:
+        await query.edit_message_text("Buslinie nicht gefunden.")
+
+async def handle_nav_button(query, payload: str) -> None:
+    """Show navigation from a station to the next one"""
+    route_number, _, leg = payload.rpartition(":")
+    route = await fetch_route_for_query(query, route_number)
+    from_idx = int(leg) if leg.isdecimal() else -1
+    to_idx = from_idx + 1
+    # Only legs the route really has get a link, so this rejects malformed,
+    # negative and out-of-range legs alike
+    link = route_leg_links(route).get((from_idx, to_idx)) if route else None
+    if link:
+        from_station = route.stations[from_idx]
+        to_station = route.stations[to_idx]
+        await query.edit_message_text("\n".join([
+            f"Navigation von {from_station['name']} nach {to_station['name']}:",
+            get_directions(from_station['name'], to_station['name']),
+            f"Karte: {link}"
+        ]), link_preview_options=LinkPreviewOptions(is_disabled=True))
+    else:
+        await query.edit_message_text("Navigation nicht möglich.")
+
+# Callback data (max. 64 bytes) is a one-character kind followed by a payload
+# each handler parses itself: "r<route>" or "n<route>:<leg>"
+BUTTON_HANDLERS = {
+    "r": handle_route_button,
+    "n": handle_nav_button,
+}
+
+def _legacy_callback_data(data: str) -> str:
+    """Translate "route_<route>" / "nav_<route>_<from>_<to>" from older keyboards"""
+    prefix, _, rest = data.partition("_")
+    if prefix == "route":
+        return f"r{rest}"
+    if prefix == "nav":
+        route_number, _, legs = rest.partition("_")
+        return f"n{route_number}:{legs.partition('_')[0]}"
+    return data
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle inline keyboard button presses"""
     query = update.callback_query
-    data = query.data
-
-    if data.startswith("route_"):
-        route_number = data.split("_")[1]
-        route = get_bus_route(route_number)
-        if route:
-            response = f"Linie {route.route_number}: {route.name}\nStationen:\n"
-            response += "\n".join([f"{i+1}. {s['name']}" for i, s in enumerate(route.stations)])
-            query.edit_message_text(response)
-        else:
-            query.edit_message_text("Buslinie nicht gefunden.")
-
-    elif data.startswith("nav_"):
-        _, route_number, from_idx, to_idx = data.split("_")
-        route = get_bus_route(route_number)
-        if route:
-            from_station = route.stations[int(from_idx)]
-            to_station = route.stations[int(to_idx)]
-            map_link = f"https://www.google.com/maps/dir/{from_station['coords'][0]},{from_station['coords'][1]}/{to_station['coords'][0]},{to_station['coords'][1]}"
-            response = f"Navigation von {from_station['name']} nach {to_station['name']}:\n"
-            response += f"Karte: {map_link}"
-            query.edit_message_text(response)
-        else:
-            query.edit_message_text("Navigation nicht möglich.")
+    # Dismiss the client's loading spinner before doing any work
+    await query.answer()
+
+    data = _legacy_callback_data(query.data)
+    kind, payload = data[:1], data[1:]
+    handler = BUTTON_HANDLERS.get(kind)
+    if handler:
+        await handler(query, payload)
 
 # --------------------------
 # Main Application
@@ -318,27 +736,57 @@ def button_callback(update: Update, context: CallbackContext) -> None:
 
 def main() -> None:
     """Start the bot"""
-    updater = Updater(os.getenv('TELEGRAM_TOKEN'))
-    dispatcher = updater.dispatcher
+    global engine, _OCR_POOL
+    # Startup work happens here, not at import: OCR workers started with spawn or
+    # forkserver re-import this module and must not repeat it
+    engine = init_db(DATABASE_URL)
+    try:
+        load_bus_routes(BUS_ROUTES_FILE)
+    except FileNotFoundError:
+        logger.warning(f"Bus routes file {BUS_ROUTES_FILE} not found")
+
+    # Workers only load tesseract lazily, so check tessdata and the language model
+    # up front instead of failing on the first upload
+    with PyTessBaseAPI(path=TESSDATA_PREFIX, lang=OCR_LANG):
+        pass
+    _OCR_POOL = _new_ocr_pool()
+
+    # Handle updates concurrently, with enough pooled connections that
+    # parallel replies don't wait for a free socket
+    application = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        .concurrent_updates(True)
+        .connection_pool_size(64)
+        .pool_timeout(60)
+        .connect_timeout(10)
+        .read_timeout(30)
+        .get_updates_connection_pool_size(8)
+        # Stay under the bot-wide 30 msg/s limit and retry on RetryAfter
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .build()
+    )
 
     # Command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("register", register_command))
-    dispatcher.add_handler(CommandHandler("schedule", schedule_command))
-    dispatcher.add_handler(CommandHandler("routes", routes_command))
-    dispatcher.add_handler(CommandHandler("route", route_command))
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("register", register_command))
+    application.add_handler(CommandHandler("schedule", schedule_command))
+    application.add_handler(CommandHandler("routes", routes_command))
+    application.add_handler(CommandHandler("route", route_command))
+    application.add_handler(CommandHandler("navigate", navigate_command))
     
-    # Document handler
-    dispatcher.add_handler(MessageHandler(Filters.document, handle_document))
+    # Document and location handlers; live location updates arrive as
+    # edited messages and are ignored so the bot replies once per share
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.LOCATION, handle_location))
     
     # Callback handler
-    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(button_callback))
 
     # Start bot
-    updater.start_polling()
     logger.info("Bot gestartet")
-    updater.idle()
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
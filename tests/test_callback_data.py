@@ -0,0 +1,62 @@
+"""Inline button callback data must fit Telegram's 64-byte limit"""
+import orjson
+import pytest
+
+from database import CALLBACK_DATA_LIMIT, BusRoute, Session, init_db, load_bus_routes
+from heidelberg_bus_bot import (
+    _legacy_callback_data,
+    _parse_routes,
+    route_navigation_markup,
+    routes_list_markup,
+    schedule_routes_markup,
+)
+
+def callback_data(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+@pytest.fixture
+def routes(tmp_path):
+    """Routes as load_bus_routes stores them, including the longest number it accepts"""
+    stations = [{"name": f"Halt {i}", "coords": [49.40 + i / 100, 8.69]} for i in range(12)]
+    # "n<route>:12" is the longest payload load_bus_routes checks for
+    longest = "9" * (CALLBACK_DATA_LIMIT - len("n:12"))
+    path = tmp_path / "bus_routes.json"
+    path.write_bytes(orjson.dumps({
+        "31": {"name": "Hauptbahnhof - Bismarckplatz", "stations": stations},
+        longest: {"name": "Längste Nummer", "stations": stations},
+        longest + "9": {"name": "Zu lang", "stations": stations},
+    }))
+    init_db("sqlite://")
+    load_bus_routes(path)
+    try:
+        yield Session.query(BusRoute).order_by(BusRoute.route_number).all()
+    finally:
+        Session.remove()
+
+def test_load_bus_routes_skips_numbers_over_the_limit(routes):
+    assert [len(route.route_number) for route in routes] == [2, CALLBACK_DATA_LIMIT - 4]
+
+def test_generated_callback_data_fits(routes):
+    data = callback_data(routes_list_markup(routes))
+    data += callback_data(schedule_routes_markup([route.route_number for route in routes]))
+    for route in routes:
+        data += callback_data(route_navigation_markup(route))
+    assert data
+    assert max(len(cb.encode()) for cb in data) <= CALLBACK_DATA_LIMIT
+
+def test_schedule_routes_are_stripped_and_fit():
+    longest = "9" * (CALLBACK_DATA_LIMIT - len("r"))
+    routes = _parse_routes(f"31, 32,,{longest},{longest}9")
+    assert routes == ["31", "32", longest]
+    data = callback_data(schedule_routes_markup(routes))
+    assert max(len(cb.encode()) for cb in data) <= CALLBACK_DATA_LIMIT
+
+@pytest.mark.parametrize("data, expected", [
+    ("route_31", "r31"),
+    ("nav_31_0_1", "n31:0"),
+    ("nav_31_4_5", "n31:4"),
+    ("r31", "r31"),
+    ("n31:0", "n31:0"),
+])
+def test_legacy_callback_data(data, expected):
+    assert _legacy_callback_data(data) == expected